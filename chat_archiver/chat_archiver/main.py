@@ -1,7 +1,8 @@
 
 import base64
+import functools
 import hashlib
-import json
+import heapq
 import logging
 import os
 import random
@@ -11,15 +12,15 @@ import signal
 import socket
 import time
 from calendar import timegm
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime
 from itertools import count
 
 import gevent.event
 import gevent.queue
 
-from common import atomic_write, listdir
-from common.chat import BATCH_INTERVAL, format_batch, get_batch_files, merge_messages
+from common import atomic_write, scandir
+from common.chat import BATCH_INTERVAL, format_batch, get_batch_files, merge_messages, read_batch
 from common.media import download_media, FailedResponse, WrongContent, Rejected
 
 from girc import Client
@@ -120,7 +121,10 @@ class Archiver(object):
 	def __init__(self, name, base_dir, channels, nick, oauth_token, download_media):
 		self.logger = logging.getLogger(type(self).__name__).getChild(name)
 		self.name = name
-		self.messages = gevent.queue.Queue()
+		# Messages are only passed between greenlets in this process, so a plain deque
+		# plus an event to wake the main loop is enough. See run().
+		self.messages = deque()
+		self.message_ready = gevent.event.Event()
 		self.channels = channels
 		self.base_dir = base_dir
 		self.download_media = download_media
@@ -157,10 +161,20 @@ class Archiver(object):
 		for command, count in by_command.items():
 			messages_written.labels(channel=channel, client=self.name, command=command).inc(count)
 
+	def write_batches(self, queue):
+		"""Write (channel, batch_time, messages) items from the queue until we get a None."""
+		for channel, batch_time, messages in iter(queue.get, None):
+			self.write_batch(channel, batch_time, messages)
+
 	def run(self):
+		# Reset the gauge in case a previous run with the same name left batches counted as open
+		for channel in self.channels:
+			open_batches.labels(channel=channel, client=self.name).set(0)
+
 		@self.client.handler(sync=True)
 		def handle_message(client, message):
-			self.messages.put(message)
+			self.messages.append(message)
+			self.message_ready.set()
 
 		# Twitch sends a RECONNECT shortly before terminating the connection from the server side.
 		# This gives us time to start up a new instance of the archiver while keeping this one
@@ -172,14 +186,26 @@ class Archiver(object):
 
 		self.client.start()
 
+		# Batches are encoded and written to disk by a seperate greenlet, so that the main loop
+		# can keep up with incoming messages and the writes happen when it's waiting.
+		# If the writer fails, stop so the error gets raised.
+		write_queue = gevent.queue.Queue()
+		writer = gevent.spawn(self.write_batches, write_queue)
+		writer.link_exception(lambda g: self.stop())
+
 		last_server_time = None
 		last_timestamped_message = None
 		# {(channel, batch time): [messages]}
 		batches = {}
-		for channel in self.channels:
-			open_batches.labels(channel=channel, client=self.name).set_function(
-				lambda: len([1 for c, t in batches if c == channel])
-			)
+		# Min-heap of (batch time, channel) for all keys in batches, so we can find the oldest
+		# batch without scanning them all.
+		batch_heap = []
+
+		# Looking up a metric's labels is surprisingly expensive, so cache the lookups
+		# for the metrics we update on every message. These take label values positionally.
+		received_counter = functools.lru_cache()(messages_received.labels)
+		ignored_counter = functools.lru_cache()(messages_ignored.labels)
+		lag_gauge = functools.lru_cache()(server_lag.labels)
 
 		# Tracks if we've seen the initial ROOMSTATE for each channel we've joined.
 		# Everything up to and including this message is per-connection:
@@ -189,49 +215,48 @@ class Archiver(object):
 		# We ignore all messages before the initial ROOMSTATE.
 		initialized_channels = set()
 
-		while not (self.stopping.is_set() and self.messages.empty()):
-			# wait until we either have a message, are stopping, or a batch can be closed
-			if batches:
-				oldest_batch_time = min(batch_time for channel, batch_time in batches.keys())
+		while not (self.stopping.is_set() and not self.messages):
+			# close any closable batches
+			now = time.time()
+			while batch_heap and now >= batch_heap[0][0] + BATCH_INTERVAL + MAX_SERVER_LAG:
+				batch_time, channel = heapq.heappop(batch_heap)
+				messages = batches.pop((channel, batch_time))
+				open_batches.labels(channel=channel, client=self.name).dec()
+				write_queue.put((channel, batch_time, messages))
+
+			# wait until we either have a message, are stopping, or the next batch can be closed
+			if batch_heap:
+				oldest_batch_time, _ = batch_heap[0]
 				next_batch_close = oldest_batch_time + BATCH_INTERVAL + MAX_SERVER_LAG
-				self.logger.debug("Next batch close at {} (batch times: {})".format(next_batch_close, list(batches.keys())))
-				timeout = max(0, next_batch_close - time.time())
+				self.logger.debug("Next batch close at {}".format(next_batch_close))
+				timeout = max(0, next_batch_close - now)
 			else:
 				timeout = None
-			self.logger.debug("Waiting up to {} for message or stop".format(timeout))
-			gevent.wait([gevent.spawn(self.messages.peek), self.stopping], count=1, timeout=timeout)
-
-			# close any closable batches
-			now = time.time()
-			for (channel, batch_time), messages in list(batches.items()):
-				if now >= batch_time + BATCH_INTERVAL + MAX_SERVER_LAG:
-					del batches[channel, batch_time]
-					self.write_batch(channel, batch_time, messages)
-
-			# consume a message if any
-			try:
-				message = self.messages.get(block=False)
-			except gevent.queue.Empty:
+			if not self.messages:
+				self.logger.debug("Waiting up to {} for message or stop".format(timeout))
+				self.message_ready.clear()
+				gevent.wait([self.message_ready, self.stopping], count=1, timeout=timeout)
 				continue
+			message = self.messages.popleft()
 
 			self.logger.debug("Got message: {}".format(message))
 
 			if message.command not in COMMANDS:
 				self.logger.info("Skipping non-whitelisted command: {}".format(message.command))
-				messages_ignored.labels(client=self.name, command=message.command, reason="non-whitelisted").inc()
+				ignored_counter(self.name, message.command, "non-whitelisted").inc()
 				continue
 
 			# For all message types we capture, the channel name is always the first param.
 			if not message.params:
 				self.logger.error(f"Skipping malformed message with no params - cannot determine channel: {message}")
-				messages_ignored.labels(client=self.name, command=message.command, reason="no-channel").inc()
+				ignored_counter(self.name, message.command, "no-channel").inc()
 				continue
 
 			channel = message.params[0].lstrip("#")
 
 			if channel not in self.channels:
 				self.logger.error(f"Skipping unexpected message for unrequested channel {channel}")
-				messages_ignored.labels(client=self.name, command=message.command, reason="bad-channel").inc()
+				ignored_counter(self.name, message.command, "bad-channel").inc()
 				continue
 
 			if channel not in initialized_channels:
@@ -239,36 +264,42 @@ class Archiver(object):
 				if message.command == "ROOMSTATE":
 					initialized_channels.add(channel)
 					self.logger.info(f"Channel {channel} is ready")
-				messages_ignored.labels(client=self.name, command=message.command, reason="non-initialized-channel").inc()
+				ignored_counter(self.name, message.command, "non-initialized-channel").inc()
 				continue
 
 			data = {
-				attr: getattr(message, attr)
-				for attr in ('command', 'params', 'sender', 'user', 'host', 'tags')
+				'command': message.command,
+				'params': message.params,
+				'sender': message.sender,
+				'user': message.user,
+				'host': message.host,
+				'tags': message.tags,
+				'receivers': {self.name: message.received_at},
 			}
-			data['receivers'] = {self.name: message.received_at}
 			self.logger.debug("Got message data: {}".format(data))
-			messages_received.labels(channel=channel, client=self.name, command=message.command).inc()
+			received_counter(channel, self.name, message.command).inc()
 
-			if data['tags'] and data['tags'].get('emotes', '') != '':
-				emote_specs = data['tags']['emotes'].split('/')
-				emote_ids = [emote_spec.split(':')[0] for emote_spec in emote_specs]
+			tags = data['tags'] or {}
+			if tags.get('emotes', '') != '':
+				emote_specs = tags['emotes'].split('/')
+				emote_ids = [emote_spec.partition(':')[0] for emote_spec in emote_specs]
 				ensure_emotes(self.base_dir, emote_ids)
 
 			if self.download_media and data['command'] == "PRIVMSG" and len(data["params"]) == 2:
 				ensure_image_links(self.base_dir, data["params"][1])
 
-			if data['tags'] and 'tmi-sent-ts' in data['tags']:
+			sent_ts = tags.get('tmi-sent-ts')
+			if sent_ts is not None:
 				# explicit server time is available
-				timestamp = int(data['tags']['tmi-sent-ts']) / 1000. # original is int ms
+				timestamp = int(sent_ts) / 1000. # original is int ms
 				last_timestamped_message = message
 				last_server_time = timestamp
-				server_lag.labels(channel=channel, client=self.name).set(time.time() - timestamp)
+				lag_gauge(channel, self.name).set(time.time() - timestamp)
 				time_range = 0
 				self.logger.debug("Message has exact timestamp: {}".format(timestamp))
 				# check for any non-timestamped messages which we now know must have been
 				# before this message. We need to check this batch and the previous.
-				batch_time = int(timestamp / BATCH_INTERVAL) * BATCH_INTERVAL
+				batch_time = int(timestamp) // BATCH_INTERVAL * BATCH_INTERVAL
 				for batch in (batch_time, batch_time - BATCH_INTERVAL):
 					for msg in batches.get((channel, batch), []):
 						time_between = timestamp - msg['time']
@@ -300,12 +331,19 @@ class Archiver(object):
 			self.logger.debug("Message time determined as {} + up to {}".format(timestamp, time_range))
 			data['time'] = timestamp
 			data['time_range'] = time_range
-			batch_time = int(timestamp / BATCH_INTERVAL) * BATCH_INTERVAL
-			batches.setdefault((channel, batch_time), []).append(data)
+			batch_time = int(timestamp) // BATCH_INTERVAL * BATCH_INTERVAL
+			if (channel, batch_time) not in batches:
+				batches[channel, batch_time] = []
+				heapq.heappush(batch_heap, (batch_time, channel))
+				open_batches.labels(channel=channel, client=self.name).inc()
+			batches[channel, batch_time].append(data)
 
 		# Close any remaining batches
 		for (channel, batch_time), messages in batches.items():
-			self.write_batch(channel, batch_time, messages)
+			open_batches.labels(channel=channel, client=self.name).dec()
+			write_queue.put((channel, batch_time, messages))
+		write_queue.put(None)
+		writer.get() # wait for writes to finish, and re-raise any errors
 
 		self.client.wait_for_stop() # re-raise any errors
 		self.logger.info("Client stopped")
@@ -314,16 +352,30 @@ class Archiver(object):
 		self.client.stop()
 
 
+# Keys of emotes and links that we've already dealt with, so we can skip them without
+# checking the filesystem. These are capped in size, forgetting the oldest entries first.
+# Values are always None, we use dicts as they remember insertion order.
+MAX_ENSURED_KEYS = 100000
+_EMOTES_ENSURED = {}
+_IMAGE_LINKS_ENSURED = {}
+
+def _mark_ensured(ensured, key):
+	ensured[key] = None
+	if len(ensured) > MAX_ENSURED_KEYS:
+		del ensured[next(iter(ensured))]
+
+
 _EMOTES_RUNNING = KeyedGroup()
 def ensure_emotes(base_dir, emote_ids):
 	"""Tries to download given emote from twitch if it doesn't already exist.
 	This happens in the background and errors are ignored.
 	"""
-	def _ensure_emote(emote_id, theme, scale):
+	def _ensure_emote(key, emote_id, theme, scale):
 		url = "https://static-cdn.jtvnw.net/emoticons/v2/{}/default/{}/{}".format(emote_id, theme, scale)
 		path = os.path.join(base_dir, "emotes", emote_id, "{}-{}".format(theme, scale))
 		if os.path.exists(path):
 			logging.debug("Emote {} already exists".format(path))
+			_mark_ensured(_EMOTES_ENSURED, key)
 			return
 		logging.info("Fetching emote from {}".format(url))
 		try:
@@ -336,6 +388,7 @@ def ensure_emotes(base_dir, emote_ids):
 			return
 		atomic_write(path, response.content)
 		logging.info("Saved emote {}".format(path))
+		_mark_ensured(_EMOTES_ENSURED, key)
 
 	for emote_id in emote_ids:
 		for theme in ('light', 'dark'):
@@ -343,7 +396,9 @@ def ensure_emotes(base_dir, emote_ids):
 				# to prevent downloading the same emote twice because the first download isn't finished yet,
 				# use a KeyedGroup.
 				key = base_dir, emote_id, theme, scale
-				_EMOTES_RUNNING.spawn(key, _ensure_emote, emote_id, theme, scale)
+				if key in _EMOTES_ENSURED:
+					continue
+				_EMOTES_RUNNING.spawn(key, _ensure_emote, key, emote_id, theme, scale)
 
 
 def wait_for_ensure_emotes():
@@ -380,9 +435,13 @@ _IMAGE_LINKS_RUNNING = KeyedGroup()
 def ensure_image_links(base_dir, text):
 	"""Find any image or video links in the text and download them if we don't have them already.
 	This happens in the background and errors are ignored."""
+	# Any match must have a dot in the hostname, so we can skip the regex for most messages
+	if "." not in text:
+		return
+
 	media_dir = os.path.join(base_dir, "media")
 
-	def get_url(url):
+	def get_url(key, url):
 		try:
 			try:
 				download_media(url, media_dir)
@@ -403,7 +462,11 @@ def ensure_image_links(base_dir, text):
 		except Rejected as e:
 			logging.warning(f"Rejected dangerous link {url}: {e}")
 		except Exception:
+			# Possibly transient, so don't mark it as done
 			logging.warning(f"Unable to fetch link {url}", exc_info=True)
+			return
+		# Either we have it or it will never succeed, don't try again.
+		_mark_ensured(_IMAGE_LINKS_ENSURED, key)
 
 	for match in URL_REGEX.finditer(text):
 		# Don't match on bare hostnames with no scheme AND no path. ie.
@@ -415,17 +478,21 @@ def ensure_image_links(base_dir, text):
 			continue
 		url = match.group(0)
 		key = (media_dir, url)
-		_IMAGE_LINKS_RUNNING.spawn(key, get_url, url)
+		if key in _IMAGE_LINKS_ENSURED:
+			continue
+		_IMAGE_LINKS_RUNNING.spawn(key, get_url, key, url)
 
 
-def write_batch(path, batch_time, messages, size_histogram=None):
-	"""Batches are named PATH/YYYY-MM-DDTHH/MM:SS-HASH.json"""
-	output = (format_batch(messages) + '\n').encode('utf-8')
+def write_batch(path, batch_time, messages, size_histogram=None, encoded=None):
+	"""Batches are named PATH/YYYY-MM-DDTHH/MM:SS-HASH.json
+	encoded is passed through to format_batch()."""
+	output = (format_batch(messages, encoded) + '\n').encode('utf-8')
 	if size_histogram is not None:
 		size_histogram.observe(len(output))
 	hash = base64.b64encode(hashlib.sha256(output).digest(), b"-_").decode().rstrip("=")
-	hour = datetime.utcfromtimestamp(batch_time).strftime("%Y-%m-%dT%H")
-	time = datetime.utcfromtimestamp(batch_time).strftime("%M:%S")
+	dt = datetime.utcfromtimestamp(batch_time)
+	hour = dt.strftime("%Y-%m-%dT%H")
+	time = "{:02d}:{:02d}".format(dt.minute, dt.second)
 	filename = os.path.join(hour, "{}-{}.json".format(time, hash))
 	filepath = os.path.join(path, filename)
 	if os.path.exists(filepath):
@@ -452,21 +519,22 @@ def merge_all(path, interval=None, stopping=None):
 		while True:
 			logging.debug("Scanning for merges")
 			by_time = {}
-			for hour in listdir(path):
-				for name in listdir(os.path.join(path, hour)):
-					if not name.endswith(".json"):
+			for hour in scandir(path):
+				if not hour.is_dir():
+					continue
+				for entry in scandir(hour.path):
+					if not entry.name.endswith(".json"):
 						continue
-					min_sec = name.split("-")[0]
-					timestamp = "{}:{}".format(hour, min_sec)
-					by_time[timestamp] = by_time.get(timestamp, 0) + 1
-			if not any(count > 1 for timestamp, count in by_time.items()):
+					min_sec = entry.name.split("-", 1)[0]
+					key = hour.name, min_sec
+					by_time[key] = by_time.get(key, 0) + 1
+			if not any(count > 1 for key, count in by_time.items()):
 				logging.info("All batches are merged")
 				break
-			for timestamp, count in by_time.items():
+			for (hour, min_sec), count in by_time.items():
 				if count > 1:
-					logging.info("Merging {} batches at time {}".format(count, timestamp))
-					batch_time = timegm(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
-					merge_batch_files(path, batch_time)
+					logging.info("Merging {} batches at time {}:{}".format(count, hour, min_sec))
+					merge_batch_files(path, parse_batch_time(hour, min_sec))
 					merges_done += 1
 		duration = monotonic() - start
 		merge_pass_duration.observe(duration)
@@ -480,6 +548,15 @@ def merge_all(path, interval=None, stopping=None):
 			stopping.wait(remaining)
 
 
+def parse_batch_time(hour, min_sec):
+	"""Inverse of the naming in write_batch(). Takes hour = "%Y-%m-%dT%H" and min_sec = "%M:%S"
+	and returns the batch time as a unix timestamp. This is much faster than strptime."""
+	return timegm((
+		int(hour[0:4]), int(hour[5:7]), int(hour[8:10]), int(hour[11:13]),
+		int(min_sec[0:2]), int(min_sec[3:5]),
+	))
+
+
 def merge_batch_files(path, batch_time):
 	"""For the given batch time, merges all the following messages:
 	- From batch files at that time
@@ -500,25 +577,25 @@ def merge_batch_files(path, batch_time):
 	# and will then be merged later.
 
 	messages = []
+	# Keep the original encoding of every message we read, so that messages that don't get merged
+	# with anything don't need to be encoded again.
+	encoded = {}
 	batch_files = [
 		batch_file
 		for time in [batch_time, batch_time - BATCH_INTERVAL, batch_time + BATCH_INTERVAL]
 		for batch_file in get_batch_files(path, time)
 	]
 	for batch_file in batch_files:
-		with open(batch_file) as f:
-			batch = f.read()
-		batch = [json.loads(line) for line in batch.strip().split("\n")]
-		messages = merge_messages(messages, batch)
+		messages = merge_messages(messages, read_batch(batch_file, encoded))
 
 	by_time = {}
 	for message in messages:
-		batch_time = int(message['time'] / BATCH_INTERVAL) * BATCH_INTERVAL
+		batch_time = int(message['time']) // BATCH_INTERVAL * BATCH_INTERVAL
 		by_time.setdefault(batch_time, []).append(message)
 
-	written = []
+	written = set()
 	for batch_time, batch in by_time.items():
-		written.append(write_batch(path, batch_time, batch))
+		written.add(write_batch(path, batch_time, batch, encoded=encoded))
 
 	for batch_file in batch_files:
 		# don't delete something we just (re-)wrote
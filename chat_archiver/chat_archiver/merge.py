@@ -1,19 +1,15 @@
 
 import argh
 import logging
-import json
 
-from common.chat import merge_messages, format_batch
+from common.chat import merge_messages, format_batch, read_batch
 
 def main(*paths, log='INFO'):
 	"""Merge all listed batch files and output result to stdout"""
 	logging.basicConfig(level=log)
 	messages = []
 	for path in paths:
-		with open(path) as f:
-			batch = f.read()
-		batch = [json.loads(line) for line in batch.strip().split("\n")]
-		messages = merge_messages(messages, batch)
+		messages = merge_messages(messages, read_batch(path))
 	print(format_batch(messages))
 
 if __name__ == '__main__':
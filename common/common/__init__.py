@@ -72,21 +72,22 @@ def format_bustime(bustime, round="millisecond"):
 	if bustime < 0:
 		sign = '-'
 		bustime = -bustime
-	total_mins, secs = divmod(bustime, 60)
+	if round == "millisecond":
+		# Round to integer milliseconds first, so that rounding up carries over into
+		# seconds and minutes, eg. 59.9999 -> 00:01:00.000, not 00:00:60.000
+		total_secs, millis = divmod(int(bustime * 1000 + 0.5), 1000)
+	elif round in ("second", "minute"):
+		total_secs = int(bustime)
+	else:
+		raise ValueError(f"Bad rounding value: {round!r}")
+	total_mins, secs = divmod(total_secs, 60)
 	hours, mins = divmod(total_mins, 60)
-	parts = [
-		"{:02d}".format(int(hours)),
-		"{:02d}".format(int(mins)),
-	]
 	if round == "minute":
-		pass
+		return f"{sign}{hours:02d}:{mins:02d}"
 	elif round == "second":
-		parts.append("{:02d}".format(int(secs)))
-	elif round == "millisecond":
-		parts.append("{:06.3f}".format(secs))
+		return f"{sign}{hours:02d}:{mins:02d}:{secs:02d}"
 	else:
-		raise ValueError("Bad rounding value: {!r}".format(round))
-	return sign + ":".join(parts)
+		return f"{sign}{hours:02d}:{mins:02d}:{secs:02d}.{millis:03d}"
 
 
 def rename(old, new):
@@ -124,6 +125,9 @@ def writeall(write, value):
 	Works for both text and binary files, as long as you pass the right value type for
 	the write function.
 	"""
+	if not isinstance(value, str):
+		# Slicing a memoryview doesn't copy, so partial writes of large values stay cheap
+		value = memoryview(value)
 	while value:
 		n = write(value)
 		if n is None:
@@ -183,3 +187,14 @@ def listdir(path):
 		if e.errno != errno.ENOENT:
 			raise
 		return []
+
+
+def scandir(path):
+	"""as os.scandir but return a list, and return [] if dir doesn't exist"""
+	try:
+		with os.scandir(path) as entries:
+			return list(entries)
+	except OSError as e:
+		if e.errno != errno.ENOENT:
+			raise
+		return []
@@ -18,20 +18,26 @@ class CachedIterator():
 		self.lock = gevent.lock.RLock()
 
 	def __iter__(self):
-		# We use a loop index here because self.items may lengthen between loops
+		# We use a loop index here because self.items may lengthen between loops.
+		# self.items is only ever appended to, never replaced, so we can keep a local reference.
+		items = self.items
+		# Fast path: if the wrapped iterator is already exhausted, items can't change any more.
+		if self.iterator is None and self.error is None:
+			yield from items
+			return
 		for i in itertools.count():
 			# are we beyond the end of the array?
-			if len(self.items) <= i:
+			if len(items) <= i:
 				# If we're more than 1 beyond the end, something has gone horribly wrong.
 				# We should've already lengthened it last iteration
-				assert len(self.items) == i, "CachedIterator logic error: {} != {}".format(len(self.items), i)
+				assert len(items) == i, "CachedIterator logic error: {} != {}".format(len(items), i)
 				# Note we don't need the lock up until now because we're only trying to be gevent-safe,
 				# not thread-safe. Simple operations like checking lengths can't be interrupted.
 				# However calling next on the iterator may cause a switch.
 				with self.lock:
 					# Taking the lock may have also caused a switch, so we need to re-check
 					# our conditions. Someone else may have already added the item we need.
-					if len(self.items) <= i:
+					if len(items) <= i:
 						# Check if the iterator is still active. If not, we've reached the end or an error.
 						if self.iterator is None:
 							if self.error is not None:
@@ -51,5 +57,5 @@ class CachedIterator():
 							self.iterator = None
 							self.error = ex
 							raise
-						self.items.append(item)
-			yield self.items[i]
+						items.append(item)
+			yield items[i]
@@ -2,6 +2,7 @@
 import json
 import logging
 import os
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
 
 from common import listdir
@@ -12,25 +13,58 @@ from common.segments import hour_paths_for_range
 # How long each batch is
 BATCH_INTERVAL = 60
 
+# The keys that identify a message. Two messages can only be merged if all these keys match.
+# The remaining keys (receivers, time and time_range) are combined when merging.
+COMPARE_KEYS = ('command', 'params', 'sender', 'user', 'host', 'tags')
 
-def format_batch(messages):
+
+def format_batch(messages, encoded=None):
+	"""Encode messages as a batch. If encoded is given, it should be a dict filled in by
+	read_batch(), and any messages from it are written out as they were read instead of being
+	re-encoded."""
 	# We need to take some care to have a consistent ordering and format here.
 	# We use a "canonicalised JSON" format, which is really just whatever the python encoder does,
 	# with compact separators and sorted keys.
-	messages = [
-		(message, json.dumps(message, separators=(',', ':'), sort_keys=True))
-		for message in messages
-	]
+	if encoded is None:
+		encoded = {}
+	lines = []
+	for message in messages:
+		cached = encoded.get(id(message))
+		if cached is not None and cached[0] is message:
+			line = cached[1]
+		else:
+			line = json.dumps(message, separators=(',', ':'), sort_keys=True)
+		lines.append((message['time'], message['time_range'], line))
 	# We sort by timestamp, then timestamp range, then if all else fails, lexiographically
 	# on the encoded representation.
-	messages.sort(key=lambda item: (item[0]['time'], item[0]['time_range'], item[1]))
-	return "\n".join(line for message, line in messages)
+	lines.sort()
+	return "\n".join(line for time, time_range, line in lines)
+
+
+def read_batch(path, encoded=None):
+	"""Read the batch file at path and return its list of messages.
+	If encoded is given, it should be a dict which is updated with the original encoded line
+	for each message, for passing to format_batch(). It is keyed by id(message) and holds a
+	reference to the message, so that the id can't be reused while the dict is alive.
+	"""
+	messages = []
+	with open(path) as f:
+		for line in f:
+			line = line.rstrip("\n")
+			if not line.strip():
+				continue
+			message = json.loads(line)
+			if encoded is not None:
+				encoded[id(message)] = message, line
+			messages.append(message)
+	return messages
 
 
 def get_batch_files(path, batch_time):
 	"""Returns list of batch filepaths for a given batch time as unix timestamp"""
-	hour = datetime.utcfromtimestamp(batch_time).strftime("%Y-%m-%dT%H")
-	time = datetime.utcfromtimestamp(batch_time).strftime("%M:%S")
+	dt = datetime.utcfromtimestamp(batch_time)
+	hour = dt.strftime("%Y-%m-%dT%H")
+	time = "{:02d}:{:02d}".format(dt.minute, dt.second)
 	hourdir = os.path.join(path, hour)
 	return [
 		os.path.join(hourdir, name)
@@ -48,12 +82,20 @@ def get_batch_file_range(hours_path, start, end):
 	# with a wide time range, which might actually be in an even earlier batch.
 	start -= timedelta(seconds=2 * BATCH_INTERVAL)
 	end += timedelta(seconds=BATCH_INTERVAL)
+	# Batch times are in whole seconds and formatted as fixed-width "HOUR:MM:SS" strings,
+	# which sort the same as the times themselves. So rather than parse every file's time,
+	# we can compare them as strings against the start and end formatted the same way.
+	# Since batch times are whole seconds, "start < time" is the same as "start rounded down < time",
+	# and "time < end" is the same as "time < end rounded up".
+	start_key = start.strftime("%Y-%m-%dT%H:%M:%S")
+	if end.microsecond:
+		end = end.replace(microsecond=0) + timedelta(seconds=1)
+	end_key = end.strftime("%Y-%m-%dT%H:%M:%S")
 	for hour_path in hour_paths_for_range(hours_path, start, end):
 		hour = os.path.basename(hour_path)
 		for name in listdir(hour_path):
 			min_sec = name.split("-")[0]
-			timestamp = datetime.strptime("{}:{}".format(hour, min_sec), "%Y-%m-%dT%H:%M:%S")
-			if start < timestamp < end:
+			if start_key < f"{hour}:{min_sec}" < end_key:
 				yield os.path.join(hour_path, name)
 
 
@@ -83,28 +125,39 @@ def merge_messages(left, right):
 
 	# Returns merged message if two messages are compatible with being the same message,
 	# or else None.
-	def merge_message(a, b):
+	def merge_message(a, b, same_id=False):
+		# Check command first as it's the cheapest and most common mismatch
+		if a['command'] != b['command']:
+			return None
 		o = overlap(a, b)
-		if o and all(
-			a.get(k) == b.get(k)
-			for k in set(a.keys()) | set(b.keys())
-			if k not in ("receivers", "time", "time_range")
-		):
-			receivers = a["receivers"] | b["receivers"]
-			# Error checking - make sure no receiver timestamps are being overwritten.
-			# This would indicate we're merging two messages recieved at different times
-			# by the same recipient.
-			for k in receivers.keys():
-				for old in (a, b):
-					if k in old and old[k] != receivers[k]:
-						raise ValueError(f"Merge would merge two messages with different recipient timestamps: {a}, {b}")
-			return a | {
-				"time": o[0],
-				"time_range": o[1],
-				"receivers": receivers,
-			}
+		if o and all(a.get(k) == b.get(k) for k in COMPARE_KEYS):
+			a_receivers = a["receivers"]
+			b_receivers = b["receivers"]
+			receivers = dict(a_receivers)
+			for k in a_receivers.keys() & b_receivers.keys():
+				if a_receivers[k] == b_receivers[k]:
+					continue
+				# If the same receiver got both messages at different times, they can't be the same
+				# message (eg. a user leaving and re-joining), so don't merge them.
+				# Messages with a matching id are the same message regardless, so keep the earliest
+				# time rather than refusing to merge, as older data may contain such conflicts.
+				if not same_id:
+					return None
+				logging.warning(f"Receiver {k} has conflicting times {a_receivers[k]} and {b_receivers[k]} for message with id {a['tags']['id']}")
+				receivers[k] = min(a_receivers[k], b_receivers[k])
+			merged = {k: a[k] for k in COMPARE_KEYS if k in a}
+			merged["time"], merged["time_range"] = o
+			for k, v in b_receivers.items():
+				receivers.setdefault(k, v)
+			merged["receivers"] = receivers
+			return merged
 		return None
 
+	# Messages can only be merged if they match on all of COMPARE_KEYS. Comparing these as a tuple
+	# lets us cheaply rule out candidates before trying a full merge.
+	def identity(message):
+		return tuple([message.get(k) for k in COMPARE_KEYS])
+
 	# Match things with identical ids first, and collect unmatched into left and right lists
 	by_id = {}
 	unmatched = [], []
@@ -122,7 +175,7 @@ def merge_messages(left, right):
 			logging.debug(f"Message with id {id} has no match")
 			result.append(messages[0])
 		else:
-			merged = merge_message(*messages)
+			merged = merge_message(*messages, same_id=True)
 			if merged is None:
 				raise ValueError(f"Got two non-matching messages with id {id}: {messages[0]}, {messages[1]}")
 			logging.debug(f"Merged messages with id {id}")
@@ -130,22 +183,65 @@ def merge_messages(left, right):
 
 	# For time-range messages, pair off each one in left with first match in right,
 	# and pass through anything with no matches.
+	# To avoid comparing every left message against every right message, we group the right
+	# messages by a hashable subset of their identity (see bucket_key()) and sort each group
+	# by time, then only try the window of candidates that could overlap. Candidates are still
+	# tried in their original order, so we pick the same match as a full scan would.
+	# Matched messages are replaced with None.
 	left_unmatched, right_unmatched = unmatched
+	if not (left_unmatched and right_unmatched):
+		# Nothing to pair up. This is the common case, as most messages have ids.
+		result += left_unmatched
+		result += right_unmatched
+		return result
+	# Messages with the same identity always have the same bucket key. Tags are left out
+	# as dicts aren't hashable, they're still checked by the full identity comparison.
+	def bucket_key(message):
+		return (
+			message['command'],
+			message.get('sender'),
+			message.get('user'),
+			message.get('host'),
+			tuple(message.get('params') or ()),
+		)
+	buckets = {}
+	for i, message in enumerate(right_unmatched):
+		buckets.setdefault(bucket_key(message), []).append((message['time'], i))
+	right_index = {}
+	for key, entries in buckets.items():
+		entries.sort()
+		right_index[key] = [time for time, i in entries], [i for time, i in entries]
+	max_time_range = max((message['time_range'] for message in right_unmatched), default=0)
+	right_identities = [identity(message) for message in right_unmatched]
 	for message in left_unmatched:
-		for other in right_unmatched:
+		message_identity = identity(message)
+		times, positions = right_index.get(bucket_key(message), ((), ()))
+		# a candidate can only overlap if it starts no more than max_time_range before us,
+		# and no later than our end.
+		lo = bisect_left(times, message['time'] - max_time_range)
+		hi = bisect_right(times, message['time'] + message['time_range'])
+		candidates = sorted(positions[lo:hi])
+		for i in candidates:
+			other = right_unmatched[i]
+			if other is None:
+				continue
+			if right_identities[i] != message_identity:
+				continue
 			merged = merge_message(message, other)
 			if merged:
 				logging.debug(
 					"Matched {m[command]} message {a[time]}+{a[time_range]} & {b[time]}+{b[time_range]} -> {m[time]}+{m[time_range]}"
 					.format(a=message, b=other, m=merged)
 				)
-				right_unmatched.remove(other)
+				right_unmatched[i] = None
 				result.append(merged)
 				break
 		else:
 			logging.debug("No match found for {m[command]} at {m[time]}+{m[time_range]}".format(m=message))
 			result.append(message)
 	for message in right_unmatched:
+		if message is None:
+			continue
 		logging.debug("No match found for {m[command]} at {m[time]}+{m[time_range]}".format(m=message))
 		result.append(message)
 
@@ -5,6 +5,7 @@ Note that this code requires psycopg2 and psycogreen, but the common module
 as a whole does not to avoid needing to install them for components that don't need it.
 """
 
+from collections import deque
 from contextlib import contextmanager
 
 import psycopg2
@@ -54,17 +55,19 @@ class DBManager(object):
 	NamedTupleCursor cursors."""
 	def __init__(self, connect_timeout=30, register_types=True, **connect_kwargs):
 		patch_psycopg()
-		self.conns = []
+		self.conns = deque()
 		self.connect_timeout = connect_timeout
 		self.register_types = register_types
 		self.connect_kwargs = connect_kwargs
+		# Composite type info from the first conn, so we don't need to look it up again for every new conn.
+		self.composite_casters = None
 
 	def put_conn(self, conn):
 		self.conns.append(conn)
 
 	def get_conn(self):
 		if self.conns:
-			return self.conns.pop(0)
+			return self.conns.popleft()
 		conn = psycopg2.connect(cursor_factory=psycopg2.extras.NamedTupleCursor,
 			connect_timeout=self.connect_timeout, **self.connect_kwargs)
 		# We use serializable because it means less issues to think about,
@@ -74,8 +77,17 @@ class DBManager(object):
 		conn.isolation_level = psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE
 		conn.autocommit = True
 		if self.register_types:
-			for composite in COMPOSITE_TYPES:
-				psycopg2.extras.register_composite(composite, conn)
+			if self.composite_casters is None:
+				self.composite_casters = [
+					psycopg2.extras.register_composite(composite, conn)
+					for composite in COMPOSITE_TYPES
+				]
+			else:
+				# This is what register_composite() does after looking up the type info
+				for caster in self.composite_casters:
+					psycopg2.extensions.register_type(caster.typecaster, conn)
+					if caster.array_typecaster is not None:
+						psycopg2.extensions.register_type(caster.array_typecaster, conn)
 		return conn
 
 
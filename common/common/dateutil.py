@@ -6,13 +6,24 @@
 # required so we are able to import dateutil despite this module also being called dateutil
 from __future__ import absolute_import
 
+from datetime import datetime
+
 import dateutil.parser
 import dateutil.tz
 
 
+def _parse(timestamp, **kwargs):
+	"""Almost all our timestamps are ISO 8601, which datetime can parse much faster than dateutil.
+	Fall back to dateutil for anything else."""
+	try:
+		return datetime.fromisoformat(timestamp)
+	except ValueError:
+		return dateutil.parser.parse(timestamp, **kwargs)
+
+
 def parse(timestamp):
 	"""Parse given timestamp, convert to UTC, and return naive UTC datetime"""
-	dt = dateutil.parser.parse(timestamp)
+	dt = _parse(timestamp)
 	if dt.tzinfo is not None:
 		dt = dt.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None)
 	return dt
@@ -20,4 +31,4 @@ def parse(timestamp):
 
 def parse_utc_only(timestamp):
 	"""Parse given timestamp, but assume it's already in UTC and ignore other timezone info"""
-	return dateutil.parser.parse(timestamp, ignoretz=True)
+	return _parse(timestamp, ignoretz=True).replace(tzinfo=None)
@@ -1,7 +1,5 @@
 
 
-import struct
-
 class FixTS():
 	"""Does stream processing on an MPEG-TS stream, adjusting all timestamps in it.
 	The stream will be adjusted such that the first packet starts at the given start_time,
@@ -44,18 +42,21 @@ class FixTS():
 		# once starting PCR/PTS is known, contains value to add to each timestamp
 		self.offsets = {"pcr": None, "pts": None}
 		# buffers fed data until a whole packet can be parsed
-		self.data = b""
+		self.data = bytearray()
 
 	def feed(self, data):
 		"""Takes more data as a bytestring to add to buffer.
 		Fixes any whole packets in the buffer and returns them as a single bytestring."""
 		self.data += data
 		output = []
-		while len(self.data) >= self.PACKET_SIZE:
-			packet = self.data[:self.PACKET_SIZE]
-			self.data = self.data[self.PACKET_SIZE:]
+		# Fix all whole packets, then remove them from the buffer in one go,
+		# instead of copying the rest of the buffer after every packet.
+		end = len(self.data) - len(self.data) % self.PACKET_SIZE
+		for start in range(0, end, self.PACKET_SIZE):
+			packet = self.data[start:start + self.PACKET_SIZE]
 			fixed_packet = self._fix_packet(packet)
 			output.append(fixed_packet)
+		del self.data[:end]
 		return b''.join(output)
 
 	def end(self):
@@ -100,6 +101,7 @@ class FixTS():
 			- If the packet header contains a PTS, fix the PTS
 			- If the packet header cannot be decoded far enough (not enough data in first packet),
 			  bail - we don't care about this edge case.
+		packet must be a bytearray, and is modified in place.
 		"""
 		assert len(packet) == self.PACKET_SIZE 
 
@@ -139,9 +141,7 @@ class FixTS():
 					check(field_length >= 7, "Adaptation field indicates PCR but is too small")
 					old_time = decode_pcr(packet[6:12])
 					new_time = self._convert_time(old_time, 'pcr')
-					encoded = encode_pcr(new_time)
-					packet = packet[:6] + encoded + packet[12:]
-					assert len(packet) == 188
+					packet[6:12] = encode_pcr(new_time)
 		else:
 			# No adapatation field, payload starts immediately after the packet header
 			payload_index = 4
@@ -183,9 +183,7 @@ class FixTS():
 					raw = packet[pts_index : pts_index + 5]
 					pts = decode_ts(raw, 2)
 					pts = self._convert_time(pts, 'pts')
-					encoded = encode_ts(pts, 2)
-					packet = packet[:pts_index] + encoded + packet[pts_index + 5:]
-					assert len(packet) == 188
+					packet[pts_index : pts_index + 5] = encode_ts(pts, 2)
 
 		return packet
 
@@ -196,26 +194,17 @@ def bits(value, start, end):
 	return (value >> start) & ((1 << size) - 1)
 
 
-def decode_padded(value, spec):
-	size = struct.calcsize(spec)
-	pad = size - len(value)
-	assert pad >= 0
-	value = b"\0" * pad + value
-	return struct.unpack(spec, value)[0]
-
-
 def encode_pcr(seconds):
 	assert seconds >= 0
 	raw = int(seconds * 27000000)
 	base, ext = divmod(raw, 300)
 	assert base < 2**33
 	value = (base << 15) + ext
-	value = struct.pack('!Q', value)
-	return value[2:]
+	return value.to_bytes(6, 'big')
 
 
 def decode_pcr(value):
-	value = decode_padded(value, '!Q')
+	value = int.from_bytes(value, 'big')
 	base = bits(value, 15, 48)
 	extension = bits(value, 0, 9)
 	raw = 300 * base + extension
@@ -232,14 +221,13 @@ def encode_ts(seconds, tag):
 	b = bits(raw, 15, 30)
 	c = bits(raw, 0, 15)
 	value = 1 + (1 << 16) + (1 << 32) + (tag << 36) + (a << 33) + (b << 17) + (c << 1)
-	value = struct.pack('!Q', value)
-	return value[3:]
+	return value.to_bytes(5, 'big')
 
 
 def decode_ts(value, tag):
 	# bits: TTTTxxx1 xxxxxxxx xxxxxxx1 xxxxxxxx xxxxxxx1
 	# T is tag, x is bits of actual number
-	value = decode_padded(value, '!Q')
+	value = int.from_bytes(value, 'big')
 	assert bits(value, 36, 40) == tag 
 	assert all(value & (1 << bit) for bit in [0, 16, 32])
 	a = bits(value, 33, 36) 
@@ -12,6 +12,7 @@ import os
 import shutil
 from collections import namedtuple
 from contextlib import contextmanager
+from functools import cached_property
 from tempfile import TemporaryFile
 from uuid import uuid4
 
@@ -143,7 +144,8 @@ class SegmentInfo(
 ):
 	"""Info parsed from a segment path, including original path.
 	Note that start time is a datetime and duration is a timedelta, and hash is a decoded binary string."""
-	@property
+	# Segments are immutable and end is checked often when selecting segments, so only compute it once.
+	@cached_property
 	def end(self):
 		return self.start + self.duration
 	@property
@@ -185,7 +187,7 @@ def parse_segment_path(path):
 			raise ValueError("Not enough dashes in filename")
 		time, duration, type, hash = parts
 		if type not in ('full', 'suspect', 'partial', 'temp'):
-			raise ValueError("Unknown type {!r}".format(type))
+			raise ValueError(f"Unknown type {type!r}")
 		hash = None if type == 'temp' else unpadded_b64_decode(hash)
 		start = None if hour is None else parse_segment_timestamp(hour, time)
 		return SegmentInfo(
@@ -199,7 +201,7 @@ def parse_segment_path(path):
 		)
 	except ValueError as e:
 		# wrap error but preserve original traceback
-		raise ValueError("Bad path {!r}: {}".format(path, e)).with_traceback(e.__traceback__)
+		raise ValueError(f"Bad path {path!r}: {e}").with_traceback(e.__traceback__)
 
 
 class ContainsHoles(Exception):
@@ -285,9 +287,12 @@ def get_best_segments(hours_path, start, end, allow_holes=True):
 						raise ContainsHoles
 					result.append(None)
 					result.append(segment)
+				elif segment.start >= end:
+					# segment starts after end, and so will every segment after it.
+					# there's nothing left to find, so stop looking.
+					break
 				else:
-					# segment is before start, and doesn't cover start, or starts after end.
-					# ignore and go to next.
+					# segment is before start, and doesn't cover start. ignore and go to next.
 					continue
 			else:
 				# normal case: check against previous segment end time
@@ -297,7 +302,7 @@ def get_best_segments(hours_path, start, end, allow_holes=True):
 					# Overlap! This shouldn't happen, though it might be possible due to weirdness
 					# if the stream drops then starts again quickly. We simply ignore the overlapping
 					# segment and let the algorithm continue.
-					logging.info("Overlapping segments: {} overlaps end of {}".format(segment, result[-1]))
+					logging.info(f"Overlapping segments: {segment} overlaps end of {result[-1]}")
 					continue
 				if result[-1].is_partial or gap > ALLOWABLE_GAP:
 					# there's a gap between prev end and this start, so add a None
@@ -383,12 +388,15 @@ def list_segment_files(hour_path, include_tombstones=False, include_chat=False):
 		return segments
 
 
-# Maps hour path to (directory contents, cached result).
+# Maps hour path to (directory contents, parsed segments, cached result).
 # If the directory contents are identical, then we can use the cached result for that hour
 # instead of re-calculating. If they have changed, we throw out the cached result.
 # Since best_segments_by_start returns an iterator that may not be entirely consumed,
 # our cached result stores both all results returned so far, and the live iterator
 # in case we need to continue consuming.
+# Parsed segments maps filename to SegmentInfo for every file parsed so far, so that when
+# the directory contents change (eg. a new segment in the current hour) we only need to parse
+# the new files.
 _best_segments_by_start_cache = {}
 
 def best_segments_by_start(hour):
@@ -400,27 +408,37 @@ def best_segments_by_start(hour):
 	segment_paths.sort()
 
 	# if result is in the cache and the segment_paths haven't changed, return cached result
+	prev_parsed = {}
 	if hour in _best_segments_by_start_cache:
-		prev_segment_paths, cached_result = _best_segments_by_start_cache[hour]
+		prev_segment_paths, prev_parsed, cached_result = _best_segments_by_start_cache[hour]
 		if prev_segment_paths == segment_paths:
 			return cached_result
 
 	# otherwise create new result and cache it
-	result = CachedIterator(_best_segments_by_start(hour, segment_paths))
-	_best_segments_by_start_cache[hour] = segment_paths, result
+	parsed_by_name = {}
+	result = CachedIterator(_best_segments_by_start(hour, segment_paths, prev_parsed, parsed_by_name))
+	_best_segments_by_start_cache[hour] = segment_paths, parsed_by_name, result
 	return result
 
 
-def _best_segments_by_start(hour, segment_paths):
-	# raise a warning for any files that don't parse as segments and ignore them
-	parsed = []
-	for name in segment_paths:
-		try:
-			parsed.append(parse_segment_path(os.path.join(hour, name)))
-		except ValueError:
-			logging.warning("Failed to parse segment {!r}".format(os.path.join(hour, name)), exc_info=True)
+def _best_segments_by_start(hour, segment_paths, prev_parsed, parsed_by_name):
+	# Segments are parsed lazily as we go, so that callers who stop early (eg. get_best_segments
+	# once it reaches its end time) don't pay to parse the rest of the hour.
+	def parse_segments():
+		# raise a warning for any files that don't parse as segments and ignore them.
+		# Re-use any segments we've already parsed, and record all parsed segments in parsed_by_name.
+		for name in segment_paths:
+			segment = prev_parsed.get(name)
+			if segment is None:
+				try:
+					segment = parse_segment_path(os.path.join(hour, name))
+				except ValueError:
+					logging.warning(f"Failed to parse segment {os.path.join(hour, name)!r}", exc_info=True)
+					continue
+			parsed_by_name[name] = segment
+			yield segment
 
-	for start_time, segments in itertools.groupby(parsed, key=lambda segment: segment.start):
+	for start_time, segments in itertools.groupby(parse_segments(), key=lambda segment: segment.start):
 		# ignore temp segments as they might go away by the time we want to use them
 		segments = [segment for segment in segments if segment.type != "temp"]
 		if not segments:
@@ -430,19 +448,21 @@ def _best_segments_by_start(hour, segment_paths):
 		full_segments = [segment for segment in segments if not segment.is_partial]
 		if full_segments:
 			if len(full_segments) != 1:
-				logging.info("Multiple versions of full segment at start_time {}: {}".format(
-					start_time, ", ".join(map(str, segments))
-				))
+				logging.info(f"Multiple versions of full segment at start_time {start_time}: {', '.join(map(str, segments))}")
 				# We've observed some cases where the same segment (with the same hash) will be reported
 				# with different durations (generally at stream end). Prefer the longer duration (followed by longest size),
 				# as this will ensure that if hashes are different we get the most data, and if they
 				# are the same it should keep holes to a minimum.
 				# If same duration and size, we have to pick one, so pick highest-sorting hash just so we're consistent.
-				sizes = {segment: os.stat(segment.path).st_size for segment in segments}
+				sizes = {segment: os.stat(segment.path).st_size for segment in full_segments}
 				full_segments = [max(full_segments, key=lambda segment: (segment.duration, sizes[segment], segment.hash))]
 			yield full_segments[0]
 			continue
 		# no full segments, fall back to measuring partials. Prefer suspect over partial.
+		# If there's only one candidate, there's nothing to compare so we can skip the stat.
+		if len(segments) == 1:
+			yield segments[0]
+			continue
 		yield max(segments, key=lambda segment: (
 			1 if segment.type == 'suspect' else 0,
 			os.stat(segment.path).st_size,
@@ -79,6 +79,11 @@ def timed(name=None,
 
 	if normalized_buckets is None:
 		normalized_buckets = buckets
+	# if all labels are constant, we can skip evaluating them on every call
+	if any(callable(v) for v in labels.values()):
+		constant_values = None
+	else:
+		constant_values = tuple((k, '' if v is None else str(v)) for k, v in labels.items())
 	# convert constant (non-callable) values into callables for consistency
 	labels = {
 		# need to create then call a function to properly bind v as otherwise it will
@@ -126,6 +131,28 @@ def timed(name=None,
 				)
 				metrics[normname] = normal_latency, normal_cputime
 
+		# Looking up a metric's labels is surprisingly expensive, so cache the labelled metrics
+		# for each set of label values. Label values are given as (name, value) pairs and passed
+		# by name, as the metrics may have been created by another timed() call with the same
+		# labels in a different order.
+		@functools.lru_cache()
+		def get_metrics(*items):
+			values = dict(items)
+			return (
+				latency.labels(**values),
+				cputime.labels(type='user', **values),
+				cputime.labels(type='system', **values),
+			)
+
+		@functools.lru_cache()
+		def get_normal_metrics(*items):
+			values = dict(items)
+			return (
+				normal_latency.labels(**values),
+				normal_cputime.labels(type='user', **values),
+				normal_cputime.labels(type='system', **values),
+			)
+
 		@functools.wraps(fn)
 		def wrapper(*args, **kwargs):
 			start_monotonic = monotonic()
@@ -145,27 +172,32 @@ def timed(name=None,
 			user_time = end_user - start_user
 			sys_time = end_sys - start_sys
 
-			label_values = {}
-			for k, v in labels.items():
-				try:
-					value = v(ret, *args, **kwargs)
-				except Exception:
-					value = None
-				label_values[k] = '' if value is None else str(value)
-			label_values.update(error='' if error is None else type(error).__name__)
+			if constant_values is None:
+				label_values = []
+				for k, v in labels.items():
+					try:
+						value = v(ret, *args, **kwargs)
+					except Exception:
+						value = None
+					label_values.append((k, '' if value is None else str(value)))
+			else:
+				label_values = list(constant_values)
+			label_values.append(('error', '' if error is None else type(error).__name__))
 
-			latency.labels(**label_values).observe(wall_time)
-			cputime.labels(type='user', **label_values).observe(user_time)
-			cputime.labels(type='system', **label_values).observe(sys_time)
+			latency_child, user_child, sys_child = get_metrics(*label_values)
+			latency_child.observe(wall_time)
+			user_child.observe(user_time)
+			sys_child.observe(sys_time)
 			if normalize:
 				try:
 					factor = normalize(ret, *args, **kwargs)
 				except Exception:
 					factor = None
 				if factor is not None and factor > 0:
-					normal_latency.labels(**label_values).observe(wall_time / factor)
-					normal_cputime.labels(type='user', **label_values).observe(user_time / factor)
-					normal_cputime.labels(type='system', **label_values).observe(sys_time / factor)
+					latency_child, user_child, sys_child = get_normal_metrics(*label_values)
+					latency_child.observe(wall_time / factor)
+					user_child.observe(user_time / factor)
+					sys_child.observe(sys_time / factor)
 
 			if error is None:
 				return ret
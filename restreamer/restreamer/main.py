@@ -19,7 +19,7 @@ from common import database, dateutil, get_best_segments, rough_cut_segments, fa
 from common.flask_stats import request_stats, after_request
 from common.images import compose_thumbnail_template, get_template
 from common.segments import smart_cut_segments, feed_input, render_segments_waveform, extract_frame, list_segment_files, get_best_segments_for_frame
-from common.chat import get_batch_file_range, merge_messages
+from common.chat import get_batch_file_range, merge_messages, read_batch
 from common.cached_iterator import CachedIterator
 
 from . import generate_hls
@@ -586,15 +586,13 @@ def get_chat_messages(channel):
 		messages = []
 		for batch_file in get_batch_file_range(hours_path, start, end):
 			try:
-				with open(batch_file) as f:
-					batch = f.read()
+				batch = read_batch(batch_file)
 			except OSError as e:
 				if e.errno != errno.ENOENT:
 					raise
 				# If file doesn't exist, retry the outer loop
 				retry = True
 				break
-			batch = [json.loads(line) for line in batch.strip().split("\n")]
 			messages = merge_messages(messages, batch)
 
 	start = start.timestamp()